@@ -55,3 +55,79 @@ albert.subject('Math').report_grade(80, 0.5)
 albert.subject('Math').report_grade(100, 0.5)
 
 print(albert.average_grade())
+
+
+
+'''
+Subject.average_grade rescans every Grade on each call, and
+Student.average_grade recomputes every subject's average each time. For
+students with long grade histories that are queried often, this adds up.
+
+Subject can instead keep running sums of score * weight and of weight,
+updated in report_grade, so its average is O(1). Student caches its average.
+Each Subject calls back into its Student when a grade is reported, and the
+Student drops the cached value then.
+'''
+class Subject:
+    def __init__(self, on_change=None):
+        self._grades = []
+        self._total = 0
+        self._total_weight = 0
+        self._on_change = on_change
+
+    def report_grade(self, score, weight):
+        self._grades.append(Grade(score, weight))
+        self._total += score * weight
+        self._total_weight += weight
+        if self._on_change is not None:
+            self._on_change()
+
+    def average_grade(self):
+        return self._total / self._total_weight
+
+
+class Student:
+    def __init__(self):
+        self._subjects = {}
+        self._average = None
+
+    def subject(self, name):
+        if name not in self._subjects:
+            self._subjects[name] = Subject(self._invalidate)
+            self._invalidate()
+        return self._subjects[name]
+
+    def _invalidate(self):
+        self._average = None
+
+    def average_grade(self):
+        if self._average is None:
+            total, count = 0, 0
+            for subject in self._subjects.values():
+                total += subject.average_grade()
+                count += 1
+            self._average = total / count
+        return self._average
+
+
+class GradeBook:
+    def __init__(self):
+        self._students = {}
+
+    def student(self, name):
+        if name not in self._students:
+            self._students[name] = Student()
+        return self._students[name]
+
+
+book = GradeBook()
+albert = book.student('Albert Einstein')
+math = albert.subject('Math')
+math.report_grade(80, 0.5)
+math.report_grade(100, 0.5)
+print(albert.average_grade())
+
+gym = albert.subject('Gym')
+gym.report_grade(100, 0.4)
+gym.report_grade(85, 0.6)
+print(albert.average_grade())
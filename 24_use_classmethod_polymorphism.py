@@ -1,11 +1,12 @@
-'''
-Not implemented yet
-'''
+import os
+import random
+from tempfile import TemporaryDirectory
+from threading import Thread
 
 '''
 1
 '''
-class Inputdata:
+class InputData:
     def read(self):
         raise NotImplementedError
 
@@ -88,9 +89,9 @@ class PathInputData(GenericInputData):
 
     @classmethod
     def generate_inputs(cls, config):
-    data_dir = config['data_dir']
-    for name in os.listdir(data_dir):
-        yield cls(os.path.join(data_dir, name))
+        data_dir = config['data_dir']
+        for name in os.listdir(data_dir):
+            yield cls(os.path.join(data_dir, name))
 
 
 class GenericWorker:
@@ -136,10 +137,944 @@ def mapreduce(worker_class, input_class, config):
     return execute(workers)
 
 def write_test_files(tmpdir):
-    ...
+    for i in range(100):
+        with open(os.path.join(tmpdir, str(i)), 'w') as f:
+            f.write('\n' * random.randint(0, 100))
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        result = mapreduce(LineCounterWorker, PathInputData, config)
+        print('There are', result, 'lines')
+
+
+
+
+'''
+3. pluggable executors
+
+execute() above starts one Thread per worker. CPU-bound map() calls are
+serialized by the GIL, and thousands of input files mean thousands of OS
+threads.
+
+concurrent.futures gives the same Executor interface for a bounded thread pool
+and a bounded process pool, so execute() can accept either one. With a process
+pool the workers are pickled to the child processes, and the mapped workers are
+pickled back so their results can be reduced in the parent.
+
+SerialExecutor runs everything in the calling thread, which is handy for
+debugging and as a baseline.
+
+A child process finds the classes and functions it receives by name in this
+module. Under the spawn and forkserver start methods it imports the module
+again first. So every demo from here on sits under a __main__ guard, and the
+later sections give their new versions of classes and functions new names
+instead of redefining these.
+'''
+from concurrent.futures import (
+    Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor)
+
+
+class SerialExecutor(Executor):
+    def __init__(self, max_workers=None):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+EXECUTORS = {
+    'serial': SerialExecutor,
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+
+def map_worker(worker):
+    worker.map()
+    return worker # Sent back to the parent when run in a child process
+
+def execute(workers, executor):
+    with executor as pool:
+        workers = list(pool.map(map_worker, workers))
+
+    first, rest = workers[0], workers[1:]
+    for worker in rest:
+        first.reduce(worker)
+    return first.result
+
+def mapreduce(worker_class, input_class, config, executor='thread',
+              max_workers=None):
+    workers = worker_class.create_workers(input_class, config)
+    return execute(workers, EXECUTORS[executor](max_workers))
+
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        for executor in EXECUTORS:
+            result = mapreduce(LineCounterWorker, PathInputData, config,
+                               executor=executor, max_workers=4)
+            print(executor, 'executor counted', result, 'lines')
+
+
+
+'''
+4. streaming tree reduction
+
+The reduce loop in execute() above is a linear fold. It runs sequentially and
+cannot start until the slowest mapper has finished.
+
+Instead, merge partial results pairwise as soon as two of them are ready. Each
+merge is submitted back to the pool, so independent merges run in parallel and
+the reduction forms a tree that overlaps with the remaining map calls.
+GenericWorker.reduce(other) is still the only merge contract.
+'''
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+def reduce_workers(first, second):
+    first.reduce(second)
+    return first
+
+def execute(workers, executor):
+    with executor as pool:
+        pending = {pool.submit(map_worker, w) for w in workers}
+        ready = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                worker = future.result()
+                if ready is None:
+                    ready = worker # Wait for a partner to merge with
+                else:
+                    pending.add(pool.submit(reduce_workers, ready, worker))
+                    ready = None
+
+    return ready.result
+
+def mapreduce(worker_class, input_class, config, executor='thread',
+              max_workers=None):
+    workers = worker_class.create_workers(input_class, config)
+    return execute(workers, EXECUTORS[executor](max_workers))
+
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        for executor in EXECUTORS:
+            result = mapreduce(LineCounterWorker, PathInputData, config,
+                               executor=executor, max_workers=4)
+            print(executor, 'executor tree-reduced', result, 'lines')
+
+
+
+'''
+5. splitting large files
+
+PathInputData.read() loads a whole file into one str, and each file is exactly
+one work unit. A single huge file ends up on a single worker.
+
+PathSplitInputData is another GenericInputData subclass, so the same
+mapreduce() call can use it without changes. Its generate_inputs() cuts every
+file into byte ranges of config['split_size'] bytes, like Hadoop input splits.
+
+A split owns every line that starts inside its byte range:
+- If the split doesn't start at offset 0, the partial line before it belongs
+  to the previous split and is skipped.
+- The last line that starts inside the range is read to its end, even when that
+  goes past the end of the range.
+'''
+class PathSplitInputData(GenericInputData):
+    def __init__(self, path, start, end):
+        super().__init__()
+        self.path = path
+        self.start = start
+        self.end = end
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            if self.start > 0:
+                f.seek(self.start - 1)
+                f.readline() # Owned by the previous split
+            if f.tell() >= self.end:
+                return ''
+            data = f.read(self.end - f.tell())
+            if not data.endswith(b'\n'):
+                data += f.readline()
+        return data.decode('utf-8')
+
+    @classmethod
+    def generate_inputs(cls, config):
+        data_dir = config['data_dir']
+        split_size = config.get('split_size', 64 * 1024 * 1024)
+        for name in os.listdir(data_dir):
+            path = os.path.join(data_dir, name)
+            size = os.path.getsize(path)
+            for start in range(0, size, split_size):
+                yield cls(path, start, min(start + split_size, size))
+
+
+def write_big_test_file(tmpdir, lines=10**5):
+    with open(os.path.join(tmpdir, 'big'), 'w') as f:
+        for i in range(lines):
+            f.write('x' * random.randint(0, 80) + '\n')
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_big_test_file(tmpdir)
+        config = {'data_dir': tmpdir, 'split_size': 256 * 1024}
+        whole = mapreduce(LineCounterWorker, PathInputData, config)
+        split = mapreduce(LineCounterWorker, PathSplitInputData, config,
+                          executor='process')
+        print('Whole file counted', whole, 'lines, splits counted', split)
+
+
+
+'''
+6. counting lines over a memory map
+
+LineCounterWorker decodes the whole file to a str just to count newlines. That
+doubles memory and pays the UTF-8 decoding cost for nothing.
+
+BinaryPathInputData adds two binary read paths that workers can opt into:
+- read_bytes() returns the raw bytes without decoding them.
+- read_mmap() is a context manager that maps the file into memory. The pages
+  come straight from the OS page cache and nothing is copied up front.
+
+mmap objects have no count() method, so MmapLineCounterWorker counts b'\n' one
+fixed-size slice at a time. Only one chunk is ever copied into a bytes object,
+regardless of the file size.
+'''
+import mmap
+from contextlib import contextmanager
+from time import time
+
+
+class BinaryPathInputData(GenericInputData):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def read(self):
+        return open(self.path).read()
+
+    def read_bytes(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @contextmanager
+    def read_mmap(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b'' # Empty files can't be mapped
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+    @classmethod
+    def generate_inputs(cls, config):
+        data_dir = config['data_dir']
+        for name in os.listdir(data_dir):
+            yield cls(os.path.join(data_dir, name))
+
+
+class MmapLineCounterWorker(GenericWorker):
+    chunk_size = 1024 * 1024
+
+    def map(self):
+        count = 0
+        with self.input_data.read_mmap() as data:
+            for start in range(0, len(data), self.chunk_size):
+                count += data[start:start + self.chunk_size].count(b'\n')
+        self.result = count
+
+    def reduce(self, other):
+        self.result += other.result
+
+
+'''
+Raise size_mb to a few thousand to reproduce the multi-GB numbers; the text
+path then needs roughly twice the file size in memory while the mmap path
+stays at one chunk.
+'''
+def write_sized_test_file(tmpdir, size_mb):
+    line = 'x' * 63 + '\n'
+    block = line * (1024 * 1024 // len(line))
+    with open(os.path.join(tmpdir, 'sized'), 'w') as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+if __name__ == '__main__':
+    size_mb = 64
+    with TemporaryDirectory() as tmpdir:
+        write_sized_test_file(tmpdir, size_mb)
+        config = {'data_dir': tmpdir}
+        for worker_class in (LineCounterWorker, MmapLineCounterWorker):
+            start = time()
+            result = mapreduce(worker_class, BinaryPathInputData, config,
+                               executor='serial')
+            end = time()
+            print('%s counted %d lines in %d MB, took %.3f seconds' %
+                  (worker_class.__name__, result, size_mb, end - start))
+
+
+
+'''
+7. caching results across runs
+
+Rerunning mapreduce() over a directory where only a few files changed maps
+every file again.
+
+ResultCache stores each worker's partial result on disk with shelve. The entry
+is keyed by the worker class and the input's identity. It is only reused when
+the input's fingerprint still matches: (size, mtime) by default, plus a content
+hash when use_hash is set. Inputs opt in by providing cache_key().
+
+Cache hits skip map() entirely. They are fed into the tree reduction as
+already-completed futures, so reduce() sees them like any other result.
+
+Every entry remembers when it was last used. On close(), the least recently
+used entries beyond max_entries are evicted. invalidate() drops the entries
+for one worker class or one input, or the whole cache.
+'''
+import hashlib
+import shelve
+
+
+class CacheablePathInputData(BinaryPathInputData):
+    def cache_key(self, use_hash=False):
+        stat = os.stat(self.path)
+        fingerprint = (stat.st_size, stat.st_mtime_ns)
+        if use_hash:
+            with open(self.path, 'rb') as f:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            fingerprint += (digest.hexdigest(),)
+        return self.path, fingerprint
+
+
+class ResultCache:
+    def __init__(self, path, max_entries=100000, use_hash=False):
+        self.max_entries = max_entries
+        self.use_hash = use_hash
+        self.hits = 0
+        self.misses = 0
+        self._shelf = shelve.open(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.evict()
+        self._shelf.close()
+
+    def _prefix(self, worker_class):
+        return '%s.%s:' % (worker_class.__module__, worker_class.__qualname__)
+
+    def _key(self, worker_class, identity):
+        return self._prefix(worker_class) + identity
+
+    def load(self, worker):
+        identity, fingerprint = worker.input_data.cache_key(self.use_hash)
+        key = self._key(type(worker), identity)
+        entry = self._shelf.get(key)
+        if entry is None or entry[0] != fingerprint:
+            self.misses += 1
+            return False
+        self.hits += 1
+        worker.result = entry[1]
+        self._shelf[key] = (fingerprint, entry[1], time())
+        return True
+
+    def store(self, worker):
+        identity, fingerprint = worker.input_data.cache_key(self.use_hash)
+        key = self._key(type(worker), identity)
+        self._shelf[key] = (fingerprint, worker.result, time())
+
+    def evict(self):
+        excess = len(self._shelf) - self.max_entries
+        if excess <= 0:
+            return
+        by_last_used = sorted(self._shelf.items(), key=lambda kv: kv[1][2])
+        for key, _ in by_last_used[:excess]:
+            del self._shelf[key]
+
+    def invalidate(self, worker_class=None, identity=None):
+        prefix = '' if worker_class is None else self._prefix(worker_class)
+        for key in list(self._shelf.keys()):
+            if not key.startswith(prefix):
+                continue
+            if identity is not None and key.partition(':')[2] != identity:
+                continue
+            del self._shelf[key]
+
+
+def execute(workers, executor, cache=None):
+    with executor as pool:
+        pending = set()
+        mapped = set()
+        for worker in workers:
+            if cache is not None and cache.load(worker):
+                future = Future()
+                future.set_result(worker)
+            else:
+                future = pool.submit(map_worker, worker)
+                mapped.add(future)
+            pending.add(future)
+
+        ready = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                worker = future.result()
+                if future in mapped and cache is not None:
+                    cache.store(worker) # Before reduce() changes the result
+                if ready is None:
+                    ready = worker
+                else:
+                    pending.add(pool.submit(reduce_workers, ready, worker))
+                    ready = None
+
+    return ready.result
+
+def mapreduce(worker_class, input_class, config, executor='thread',
+              max_workers=None, cache=None):
+    workers = worker_class.create_workers(input_class, config)
+    return execute(workers, EXECUTORS[executor](max_workers), cache=cache)
+
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        data_dir = os.path.join(tmpdir, 'data')
+        os.mkdir(data_dir)
+        write_test_files(data_dir)
+        config = {'data_dir': data_dir}
+        with ResultCache(os.path.join(tmpdir, 'cache')) as cache:
+            for run in range(2):
+                result = mapreduce(LineCounterWorker, CacheablePathInputData,
+                                   config, cache=cache)
+                print('Run', run, 'counted', result, 'lines with',
+                      cache.hits, 'hits and', cache.misses, 'misses')
+
+            with open(os.path.join(data_dir, '0'), 'a') as f:
+                f.write('\n' * 1000) # Changes the size, so this one misses
+            result = mapreduce(LineCounterWorker, CacheablePathInputData,
+                               config, cache=cache)
+            print('After an append counted', result, 'lines with',
+                  cache.hits, 'hits and', cache.misses, 'misses')
+
+            cache.invalidate(LineCounterWorker)
+            result = mapreduce(LineCounterWorker, CacheablePathInputData,
+                               config, cache=cache)
+            print('After invalidating counted', result, 'lines with',
+                  cache.hits, 'hits and', cache.misses, 'misses')
+
+
+
+'''
+8. streaming inputs with bounded concurrency
+
+create_workers() builds a list with one worker per file before anything runs,
+which defeats the generator in generate_inputs(). os.listdir() also has to
+finish scanning the whole directory first.
+
+Here ScandirPathInputData.generate_inputs() walks the directory with
+os.scandir(), and StreamingWorker.create_workers() is a generator too.
+execute() pulls the next worker only while fewer than max_in_flight futures
+are pending. Memory stays flat as the directory grows, and the first map()
+call starts as soon as the first entry is scanned.
+'''
+class ScandirPathInputData(GenericInputData):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def read(self):
+        return open(self.path).read()
+
+    def read_bytes(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @contextmanager
+    def read_mmap(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b''
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+    def cache_key(self, use_hash=False):
+        stat = os.stat(self.path)
+        fingerprint = (stat.st_size, stat.st_mtime_ns)
+        if use_hash:
+            with open(self.path, 'rb') as f:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            fingerprint += (digest.hexdigest(),)
+        return self.path, fingerprint
+
+    @classmethod
+    def generate_inputs(cls, config):
+        with os.scandir(config['data_dir']) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    yield cls(entry.path)
+
+
+class StreamingWorker:
+    def __init__(self, input_data):
+        self.input_data = input_data
+        self.result = None
+
+    def map(self):
+        raise NotImplementedError
+
+    def reduce(self, other):
+        raise NotImplementedError
+
+    @classmethod
+    def create_workers(cls, input_class, config):
+        for input_data in input_class.generate_inputs(config):
+            yield cls(input_data)
+
+
+class StreamingLineCounterWorker(StreamingWorker):
+    def map(self):
+        data = self.input_data.read()
+        self.result = data.count('\n')
+
+    def reduce(self, other):
+        self.result += other.result
+
+
+def execute(workers, executor, max_in_flight=64, cache=None):
+    workers = iter(workers)
+    with executor as pool:
+        pending = set()
+        mapped = set()
+        ready = None
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                worker = next(workers, None)
+                if worker is None:
+                    exhausted = True
+                elif cache is not None and cache.load(worker):
+                    future = Future()
+                    future.set_result(worker)
+                    pending.add(future)
+                else:
+                    future = pool.submit(map_worker, worker)
+                    mapped.add(future)
+                    pending.add(future)
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                worker = future.result()
+                if future in mapped:
+                    mapped.remove(future)
+                    if cache is not None:
+                        cache.store(worker)
+                if ready is None:
+                    ready = worker
+                else:
+                    pending.add(pool.submit(reduce_workers, ready, worker))
+                    ready = None
+
+    return ready.result
+
+def mapreduce(worker_class, input_class, config, executor='thread',
+              max_workers=None, max_in_flight=64, cache=None):
+    workers = worker_class.create_workers(input_class, config)
+    return execute(workers, EXECUTORS[executor](max_workers),
+                   max_in_flight=max_in_flight, cache=cache)
+
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        for executor in EXECUTORS:
+            result = mapreduce(StreamingLineCounterWorker,
+                               ScandirPathInputData, config,
+                               executor=executor, max_workers=4,
+                               max_in_flight=8)
+            print(executor, 'executor streamed', result, 'lines')
+
+
+
+'''
+9. combiners and metrics
+
+With a process pool every mapped worker is pickled back to the parent, even
+though most of them are merged right away. CombiningWorker adds an optional
+combine() hook that pre-aggregates a batch of workers inside the pool, so only
+one partial result per batch crosses the process boundary. By default
+combine() is just reduce().
+
+Without numbers it's also impossible to tell whether a slow job is I/O-bound
+in read() or CPU-bound in map(). MeteredPathInputData keeps track of
+bytes_read and of read_seconds, the time spent reading. Each pool task returns
+a MapReduceStats next to its worker, with per-phase and per-worker timings.
+The 'read' phase is the time spent in the input's read methods, and the 'map'
+phase is the rest of map(). The parent merges all of these and mapreduce()
+returns the stats next to the result.
+
+read_mmap() only maps the file, and its pages are read as map() touches them.
+So for mmap workers the I/O time shows up in the 'map' phase.
+
+Pool tasks measure themselves, so the phase timings add up the time spent
+across all workers, not wall-clock time.
+'''
+from collections import defaultdict
+from copy import copy, deepcopy
+from time import perf_counter
+
+
+class MeteredPathInputData(GenericInputData):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+
+    def read(self):
+        return self.read_bytes().decode('utf-8')
+
+    def read_bytes(self):
+        start = perf_counter()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.read_seconds += perf_counter() - start
+        self.bytes_read += len(data)
+        return data
+
+    @contextmanager
+    def read_mmap(self):
+        start = perf_counter()
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.bytes_read += size
+            if size == 0:
+                self.read_seconds += perf_counter() - start
+                yield b''
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.read_seconds += perf_counter() - start
+                yield data
+
+    def cache_key(self, use_hash=False):
+        stat = os.stat(self.path)
+        fingerprint = (stat.st_size, stat.st_mtime_ns)
+        if use_hash:
+            with open(self.path, 'rb') as f:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            fingerprint += (digest.hexdigest(),)
+        return self.path, fingerprint
+
+    @classmethod
+    def generate_inputs(cls, config):
+        with os.scandir(config['data_dir']) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    yield cls(entry.path)
+
+
+class CombiningWorker:
+    def __init__(self, input_data):
+        self.input_data = input_data
+        self.result = None
+
+    def map(self):
+        raise NotImplementedError
+
+    def combine(self, other):
+        self.reduce(other)
+
+    def reduce(self, other):
+        raise NotImplementedError
+
+    @classmethod
+    def create_workers(cls, input_class, config):
+        for input_data in input_class.generate_inputs(config):
+            yield cls(input_data)
+
+
+class CombiningLineCounterWorker(CombiningWorker):
+    def map(self):
+        data = self.input_data.read()
+        self.result = data.count('\n')
+
+    def reduce(self, other):
+        self.result += other.result
+
+
+class MapReduceStats:
+    def __init__(self):
+        self.phase_seconds = defaultdict(float)
+        self.bytes_read = 0
+        self.worker_seconds = []
+
+    def merge(self, other):
+        for phase, seconds in other.phase_seconds.items():
+            self.phase_seconds[phase] += seconds
+        self.bytes_read += other.bytes_read
+        self.worker_seconds.extend(other.worker_seconds)
+
+    def __repr__(self):
+        phases = ', '.join('%s=%.3fs' % (phase, seconds)
+                           for phase, seconds in self.phase_seconds.items())
+        return '<MapReduceStats %s, bytes_read=%d, workers=%d>' % (
+            phases, self.bytes_read, len(self.worker_seconds))
+
+
+def snapshot_worker(worker):
+    snapshot = copy(worker)
+    snapshot.result = deepcopy(worker.result)
+    return snapshot
+
+def map_batch(workers, keep_mapped=False):
+    stats = MapReduceStats()
+    for worker in workers:
+        start = perf_counter()
+        worker.map()
+        duration = perf_counter() - start
+        read_seconds = getattr(worker.input_data, 'read_seconds', 0.0)
+        stats.phase_seconds['read'] += read_seconds
+        stats.phase_seconds['map'] += duration - read_seconds
+        stats.worker_seconds.append(duration)
+        stats.bytes_read += getattr(worker.input_data, 'bytes_read', 0)
+
+    # Snapshots for the cache, taken before combine() changes the first
+    # worker's result. The result is deep-copied because reduce() may merge
+    # in place, which would also change a result shared with a shallow copy.
+    mapped = [snapshot_worker(w) for w in workers] if keep_mapped else []
+
+    start = perf_counter()
+    first, rest = workers[0], workers[1:]
+    for worker in rest:
+        first.combine(worker)
+    stats.phase_seconds['combine'] += perf_counter() - start
+    return first, stats, mapped
+
+def reduce_with_stats(first, second):
+    stats = MapReduceStats()
+    start = perf_counter()
+    first.reduce(second)
+    stats.phase_seconds['reduce'] += perf_counter() - start
+    return first, stats, []
+
+def next_batch(workers, batch_size, stats):
+    start = perf_counter()
+    batch = []
+    for worker in workers:
+        batch.append(worker)
+        if len(batch) == batch_size:
+            break
+    stats.phase_seconds['input'] += perf_counter() - start
+    return batch
+
+def execute(workers, executor, max_in_flight=64, batch_size=16, cache=None):
+    workers = iter(workers)
+    stats = MapReduceStats()
+    with executor as pool:
+        pending = set()
+        ready = None
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                batch = next_batch(workers, batch_size, stats)
+                exhausted = len(batch) < batch_size
+                to_map = []
+                for worker in batch:
+                    if cache is not None and cache.load(worker):
+                        future = Future()
+                        future.set_result((worker, MapReduceStats(), []))
+                        pending.add(future)
+                    else:
+                        to_map.append(worker)
+                if to_map:
+                    pending.add(pool.submit(
+                        map_batch, to_map, keep_mapped=cache is not None))
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                worker, task_stats, mapped = future.result()
+                stats.merge(task_stats)
+                for mapped_worker in mapped:
+                    cache.store(mapped_worker)
+                if ready is None:
+                    ready = worker
+                else:
+                    pending.add(pool.submit(reduce_with_stats, ready, worker))
+                    ready = None
+
+    return ready.result, stats
+
+def mapreduce(worker_class, input_class, config, executor='thread',
+              max_workers=None, max_in_flight=64, batch_size=16, cache=None):
+    workers = worker_class.create_workers(input_class, config)
+    return execute(workers, EXECUTORS[executor](max_workers),
+                   max_in_flight=max_in_flight, batch_size=batch_size,
+                   cache=cache)
+
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        for executor in EXECUTORS:
+            result, stats = mapreduce(
+                CombiningLineCounterWorker, MeteredPathInputData, config,
+                executor=executor, max_workers=4)
+            print(executor, 'executor counted', result, 'lines', stats)
+
+
+
+'''
+10. asyncio input reading
+
+Some inputs come from slow I/O sources. A blocking read() ties up one pool
+thread for the whole wait, so thousands of concurrent reads would need
+thousands of threads.
+
+AsyncGenericInputData has an async read() instead. async_mapreduce() starts
+`concurrency` consumer coroutines on one event loop. They all pull from the
+same generate_inputs() generator, so the number of inputs in memory stays
+bounded. Each consumer awaits read(), then hands the CPU work in
+worker.map_data(data) to a bounded executor. It reduces the returned worker
+into its own partial result, and the partials are reduced once all consumers
+finish.
+
+There is no asynchronous file API in the standard library, so
+AsyncPathInputData reads through asyncio.to_thread(). SlowInputData simulates a
+high-latency source such as a network service.
+'''
+import asyncio
+
+
+class AsyncGenericInputData:
+    async def read(self):
+        raise NotImplementedError
+
+    @classmethod
+    def generate_inputs(cls, config):
+        raise NotImplementedError
+
+
+class AsyncPathInputData(AsyncGenericInputData):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    async def read(self):
+        return await asyncio.to_thread(self._read)
+
+    def _read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    @classmethod
+    def generate_inputs(cls, config):
+        with os.scandir(config['data_dir']) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    yield cls(entry.path)
+
+
+class SlowInputData(AsyncGenericInputData):
+    def __init__(self, lines, latency):
+        super().__init__()
+        self.lines = lines
+        self.latency = latency
+
+    async def read(self):
+        await asyncio.sleep(self.latency) # Waiting on a remote source
+        return '\n' * self.lines
+
+    @classmethod
+    def generate_inputs(cls, config):
+        for _ in range(config['count']):
+            yield cls(random.randint(0, 100), config['latency'])
+
+
+class AsyncLineCounterWorker(CombiningWorker):
+    def map_data(self, data):
+        self.result = data.count('\n')
+
+    def reduce(self, other):
+        self.result += other.result
+
+
+def map_data_worker(worker, data):
+    worker.map_data(data)
+    return worker
+
+async def consume_inputs(worker_class, inputs, pool):
+    loop = asyncio.get_running_loop()
+    partial = None
+    for input_data in inputs: # Shared with the other consumers
+        data = await input_data.read()
+        worker = await loop.run_in_executor(
+            pool, map_data_worker, worker_class(input_data), data)
+        if partial is None:
+            partial = worker
+        else:
+            partial.reduce(worker)
+    return partial
+
+async def async_mapreduce(worker_class, input_class, config, concurrency=1000,
+                          executor='thread', max_workers=None):
+    inputs = input_class.generate_inputs(config)
+    with EXECUTORS[executor](max_workers) as pool:
+        partials = await asyncio.gather(*(
+            consume_inputs(worker_class, inputs, pool)
+            for _ in range(concurrency)))
+
+    partials = [p for p in partials if p is not None]
+    first, rest = partials[0], partials[1:]
+    for worker in rest:
+        first.reduce(worker)
+    return first.result
+
 
-with TemporaryDirectory() as tmpdir:
-    write_test_files(tmpdir)
-    config = {'data_dir': tmpdir}
-    result = mapreduce(LineCountWorker, PathInputData, config)
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        result = asyncio.run(async_mapreduce(
+            AsyncLineCounterWorker, AsyncPathInputData, config,
+            concurrency=10))
+        print('async_mapreduce counted', result, 'lines')
 
+    config = {'count': 10000, 'latency': 0.1}
+    start = time()
+    result = asyncio.run(async_mapreduce(
+        AsyncLineCounterWorker, SlowInputData, config, executor='serial'))
+    end = time()
+    print('Read %d slow inputs and counted %d lines, took %.3f seconds' %
+          (config['count'], result, end - start))
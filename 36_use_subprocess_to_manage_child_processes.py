@@ -94,3 +94,735 @@ except subprocess.TimeoutExpired:
 
 print('Exit status', proc.poll())
 print()
+
+
+'''
+Bounded subprocess pool
+
+The loops above start one child per item with no limit, and the first example
+waits with `while proc.poll() is None`, a busy loop that pegs a core.
+
+SubprocessPool caps the number of running children at max_workers and queues
+the rest. submit() returns a Future that resolves to a CompletedProcess with
+the exit status and the captured stdout.
+
+A single dispatcher thread waits in a selector for every event at once:
+- stdout data, or EOF, from each child,
+- room in each child's stdin pipe for more input,
+- each child's exit, through a pidfd that becomes readable when the child
+  exits (os.pidfd_open, Linux 5.3+),
+- a wakeup pipe that submit() writes to.
+Nothing is polled. Where pidfds aren't available, the child is reaped with
+wait() as soon as its stdout reaches EOF.
+
+A Future cancelled while it is still queued is skipped, and children are
+launched outside the lock so submit() never waits on a fork. Any exception
+from starting a job or handling its events fails that job's Future, and its
+child is killed. The dispatcher keeps running the other jobs.
+'''
+import selectors
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+
+class SubprocessJob:
+    def __init__(self, args, input, future):
+        self.args = args
+        self.input = memoryview(input) if input else None
+        self.future = future
+        self.proc = None
+        self.chunks = []
+        self.open_streams = 0
+        self.exited = False
+        self.finished = False
+
+
+class SubprocessPool:
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.queued = deque()
+        self.running = 0
+        self.shutting_down = False
+        self.selector = selectors.DefaultSelector()
+        self.wake_read, self.wake_write = os.pipe()
+        self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self.dispatch, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def submit(self, args, input=None):
+        future = Future()
+        with self.lock:
+            if self.shutting_down:
+                raise RuntimeError('cannot submit after shutdown')
+            self.queued.append(SubprocessJob(args, input, future))
+        os.write(self.wake_write, b'\0')
+        return future
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+        os.write(self.wake_write, b'\0')
+        self.thread.join()
+        self.selector.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+    def dispatch(self):
+        while True:
+            with self.lock:
+                jobs = []
+                while self.queued and self.running < self.max_workers:
+                    job = self.queued.popleft()
+                    if job.future.set_running_or_notify_cancel():
+                        jobs.append(job)
+                        self.running += 1 # Reserves a slot for launch()
+                if self.shutting_down and not self.queued and not self.running:
+                    return
+
+            for job in jobs:
+                self.launch(job) # Outside the lock, so submit() isn't blocked
+
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    os.read(self.wake_read, 4096) # Just a wakeup
+                else:
+                    callback, job = key.data
+                    try:
+                        callback(job, key.fd)
+                    except Exception as e:
+                        self.fail(job, e)
+
+    def launch(self, job):
+        try:
+            self.start(job)
+        except Exception as e:
+            # Bad args raise TypeError or ValueError from Popen, not just
+            # OSError, and none of them may kill the dispatcher thread
+            self.fail(job, e)
+
+    def start(self, job):
+        job.proc = subprocess.Popen(
+            job.args,
+            stdin=subprocess.PIPE if job.input else subprocess.DEVNULL,
+            stdout=subprocess.PIPE)
+        stdout = job.proc.stdout.fileno()
+        self.selector.register(stdout, selectors.EVENT_READ,
+                               (self.on_stdout, job))
+        job.open_streams += 1
+        if job.input:
+            stdin = job.proc.stdin.fileno()
+            os.set_blocking(stdin, False)
+            self.selector.register(stdin, selectors.EVENT_WRITE,
+                                   (self.on_stdin, job))
+            job.open_streams += 1
+        if hasattr(os, 'pidfd_open'):
+            pidfd = os.pidfd_open(job.proc.pid)
+            self.selector.register(pidfd, selectors.EVENT_READ,
+                                   (self.on_exit, job))
+
+    def on_stdout(self, job, fd):
+        data = os.read(fd, 64 * 1024)
+        if data:
+            job.chunks.append(data)
+            return
+        self.selector.unregister(fd)
+        job.proc.stdout.close()
+        self.close_stream(job)
+
+    def on_stdin(self, job, fd):
+        try:
+            written = os.write(fd, job.input[:64 * 1024])
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            written = len(job.input) # The child stopped reading
+        job.input = job.input[written:]
+        if job.input:
+            return
+        self.selector.unregister(fd)
+        job.proc.stdin.close()
+        self.close_stream(job)
+
+    def on_exit(self, job, pidfd):
+        self.selector.unregister(pidfd)
+        os.close(pidfd)
+        job.exited = True
+        self.maybe_finish(job)
+
+    def close_stream(self, job):
+        job.open_streams -= 1
+        if not hasattr(os, 'pidfd_open') and not job.open_streams:
+            job.exited = True
+        self.maybe_finish(job)
+
+    def maybe_finish(self, job):
+        if job.open_streams or not job.exited:
+            return
+        # With a pidfd the child has already exited. Without one, its stdout
+        # has just reached EOF, and this blocks the dispatcher until a child
+        # that closed stdout early actually exits.
+        returncode = job.proc.wait()
+        job.finished = True
+        with self.lock:
+            self.running -= 1
+        settle(job.future, result=subprocess.CompletedProcess(
+            job.args, returncode, stdout=b''.join(job.chunks)))
+
+    def fail(self, job, error):
+        if job.finished:
+            return
+        job.finished = True
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None and key.data[1] is job:
+                self.selector.unregister(key.fd)
+                if key.data[0] == self.on_exit:
+                    os.close(key.fd) # The pidfd is ours; the pipes aren't
+        if job.proc is not None:
+            job.proc.kill()
+            for stream in (job.proc.stdin, job.proc.stdout):
+                if stream is not None:
+                    stream.close()
+            job.proc.wait()
+        with self.lock:
+            self.running -= 1
+        os.write(self.wake_write, b'\0') # A queued job can take the slot
+        settle(job.future, exception=error)
+
+
+def settle(future, result=None, exception=None):
+    # A Future in an unexpected state must not kill the dispatcher thread
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+with SubprocessPool(max_workers=4) as pool:
+    future = pool.submit(['echo', 'Hello from the pool!'])
+    print(future.result().stdout.decode('utf-8'))
+
+    start = time.time()
+    futures = [pool.submit(['sleep', '0.01']) for _ in range(100)]
+    statuses = [future.result().returncode for future in futures]
+    end = time.time()
+    print('%d children, at most 4 at a time, finished in %.3f seconds' %
+          (len(statuses), end - start))
+
+    data = os.urandom(1024 * 1024)
+    result = pool.submit(['cat'], input=data).result()
+    print('cat echoed', len(result.stdout), 'bytes, exit status',
+          result.returncode)
+print()
+
+
+'''
+asyncio process pipelines
+
+The run_openssl | run_md5 example collects its results with sequential
+communicate() calls, so one slow chain holds up the collection of all the
+others.
+
+run_process_pipeline() starts a chain of commands, connecting each child's
+stdout to the next child's stdin with an os.pipe(). It feeds the input to the
+first child, reads the last child's output and waits for every child, all
+concurrently. If that takes longer than timeout, every child in the chain is
+terminated and subprocess.TimeoutExpired is raised, like the communicate()
+timeout handling above does for one process. The chain is also terminated if
+the caller cancels the task.
+
+The result's returncode is the first non-zero exit status in the chain, like a
+shell with pipefail, so a failing openssl in front of md5 isn't reported as a
+success. returncodes holds the exit status of every stage.
+
+run_process_pipelines() runs many chains at once. It yields
+(index, result or TimeoutExpired) in the order the chains finish.
+'''
+import asyncio
+import shutil
+
+MD5_COMMAND = ['md5'] if shutil.which('md5') else ['md5sum']
+
+
+async def run_process_pipeline(commands, input=None, timeout=None, env=None):
+    procs = []
+    if input is None:
+        stdin = asyncio.subprocess.DEVNULL
+    else:
+        stdin = asyncio.subprocess.PIPE
+    try:
+        for i, command in enumerate(commands):
+            if i == len(commands) - 1:
+                read_fd, stdout = None, asyncio.subprocess.PIPE
+            else:
+                read_fd, stdout = os.pipe()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *command, stdin=stdin, stdout=stdout, env=env)
+            finally:
+                # The children hold their own copies of these ends
+                if stdin >= 0:
+                    os.close(stdin)
+                if stdout >= 0:
+                    os.close(stdout)
+                stdin = read_fd # Owned by the next command from here on
+            procs.append(proc)
+    except BaseException:
+        if stdin is not None and stdin >= 0:
+            os.close(stdin)
+        for proc in procs:
+            proc.kill()
+            await proc.wait()
+        raise
+
+    async def feed():
+        if input is not None:
+            procs[0].stdin.write(input)
+            try:
+                await procs[0].stdin.drain()
+            except BrokenPipeError:
+                pass # The child exited without reading everything
+            procs[0].stdin.close()
+
+    async def run_chain():
+        results = await asyncio.gather(
+            feed(), procs[-1].stdout.read(), *(p.wait() for p in procs))
+        return results[1]
+
+    try:
+        stdout = await asyncio.wait_for(run_chain(), timeout)
+    except asyncio.TimeoutError:
+        await terminate_chain(procs)
+        raise subprocess.TimeoutExpired(commands, timeout)
+    except asyncio.CancelledError:
+        await terminate_chain(procs)
+        raise
+
+    returncodes = [proc.returncode for proc in procs]
+    # Like pipefail: a failure anywhere in the chain fails the whole chain
+    returncode = next((code for code in returncodes if code), 0)
+    result = subprocess.CompletedProcess(commands, returncode, stdout=stdout)
+    result.returncodes = returncodes
+    return result
+
+async def terminate_chain(procs):
+    for proc in procs:
+        if proc.returncode is None:
+            proc.terminate()
+    for proc in procs:
+        await proc.wait()
+
+async def run_process_pipelines(pipelines, timeout=None, env=None):
+    async def run(index, commands, input):
+        try:
+            result = await run_process_pipeline(
+                commands, input=input, timeout=timeout, env=env)
+        except subprocess.TimeoutExpired as e:
+            result = e
+        return index, result
+
+    tasks = [asyncio.create_task(run(index, commands, input))
+             for index, (commands, input) in enumerate(pipelines)]
+    for next_done in asyncio.as_completed(tasks):
+        yield await next_done
+
+
+async def hash_encrypted_data():
+    env = os.environ.copy()
+    env['password'] = b'\xe24U\n\xd0Ql3S\x11'
+    openssl = ['openssl', 'enc', '-des3', '-pass', 'env:password']
+    pipelines = [([openssl, MD5_COMMAND], os.urandom(10)) for _ in range(3)]
+    pipelines.append(([['sleep', '10'], ['cat']], None)) # Too slow
+
+    async for index, result in run_process_pipelines(
+            pipelines, timeout=0.5, env=env):
+        if isinstance(result, subprocess.TimeoutExpired):
+            print('Pipeline', index, 'timed out')
+        else:
+            print('Pipeline', index, 'exit status', result.returncode,
+                  result.stdout.strip())
+
+asyncio.run(hash_encrypted_data())
+print()
+
+
+'''
+Streaming large payloads
+
+run_openssl writes the whole payload with proc.stdin.write(data), and
+communicate() then buffers all of stdout in memory. For multi-GB inputs the
+write blocks once the child fills its stdout pipe, and nobody is reading that
+pipe yet. Even without the deadlock, the whole output is held in memory.
+
+stream_subprocess() feeds stdin from a writer thread while the caller reads
+stdout, so neither pipe can fill up and stall the other. It yields stdout
+chunks as they arrive, and at most about one chunk per direction is held in
+memory at a time. The child is killed only if the caller stops reading early.
+After end of file it is waited for, so a child that closes stdout before it
+exits still reports its own exit status.
+
+The source is either an iterable of bytes chunks or a real file. A file's data
+goes to the pipe without passing through Python:
+- os.splice() (Linux, Python 3.10+) moves it between the two descriptors
+  inside the kernel.
+- os.sendfile() is the fallback on Linux, where it can write to a pipe.
+- Everywhere else, or when either call fails with an OSError (say, a file
+  system that doesn't support it), the rest of the file is copied in chunks.
+'''
+import hashlib
+import sys
+import tempfile
+
+
+def copy_file_to_pipe(source, pipe, chunk_size):
+    in_fd, out_fd = source.fileno(), pipe.fileno()
+    offset = source.tell()
+    try:
+        if hasattr(os, 'splice'):
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            while os.splice(in_fd, out_fd, chunk_size):
+                pass
+            return
+        if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            while True:
+                sent = os.sendfile(out_fd, in_fd, offset, chunk_size)
+                if not sent:
+                    return
+                offset += sent
+    except BrokenPipeError:
+        raise
+    except OSError:
+        # Not every file system supports these calls. A failed call moves
+        # nothing, so the rest of the file is copied in chunks below.
+        if hasattr(os, 'splice'):
+            offset = os.lseek(in_fd, 0, os.SEEK_CUR)
+
+    source.seek(offset)
+    for chunk in iter(lambda: source.read(chunk_size), b''):
+        pipe.write(chunk)
+
+def feed_stdin(proc, source, chunk_size, errors):
+    try:
+        if hasattr(source, 'fileno'):
+            copy_file_to_pipe(source, proc.stdin, chunk_size)
+        else:
+            for chunk in source:
+                proc.stdin.write(chunk)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass # The child stopped reading; its exit status will tell why
+    except Exception as e:
+        errors.append(e)
+        proc.kill()
+
+def stream_subprocess(args, source, chunk_size=64 * 1024, **kwargs):
+    proc = subprocess.Popen(
+        args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, **kwargs)
+    errors = []
+    writer = threading.Thread(
+        target=feed_stdin, args=(proc, source, chunk_size, errors))
+    writer.start()
+    reached_eof = False
+    try:
+        while True:
+            chunk = proc.stdout.read1(chunk_size) # Whatever has arrived
+            if not chunk:
+                reached_eof = True
+                break
+            yield chunk
+    finally:
+        if not reached_eof and proc.poll() is None:
+            proc.kill() # The caller stopped before the end
+        writer.join()
+        proc.stdout.close()
+        proc.wait()
+
+    if errors:
+        raise errors[0]
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+
+
+def random_chunks(size, chunk_size=1024 * 1024):
+    for _ in range(size // chunk_size):
+        yield os.urandom(chunk_size)
+
+with tempfile.TemporaryFile() as source:
+    for chunk in random_chunks(64 * 1024 * 1024):
+        source.write(chunk)
+    source.seek(0)
+    digest = hashlib.md5()
+    for chunk in iter(lambda: source.read(1024 * 1024), b''):
+        digest.update(chunk)
+    expected = digest.hexdigest()
+    source.seek(0)
+
+    start = time.time()
+    digest = hashlib.md5()
+    for chunk in stream_subprocess(['cat'], source):
+        digest.update(chunk)
+    end = time.time()
+    print('Streamed a 64 MB file through cat in %.3f seconds, '
+          'md5 matches: %s' % (end - start, digest.hexdigest() == expected))
+
+env = os.environ.copy()
+env['password'] = b'\xe24U\n\xd0Ql3S\x11'
+encrypted = 0
+for chunk in stream_subprocess(
+        ['openssl', 'enc', '-des3', '-pass', 'env:password'],
+        random_chunks(16 * 1024 * 1024), env=env):
+    encrypted += len(chunk)
+print('Encrypted 16 MB into', encrypted, 'bytes')
+print()
+
+
+'''
+Persistent coprocesses
+
+Every run_openssl or run_md5 call pays for a full fork and exec plus the
+child's startup. For 10-byte payloads that overhead dominates.
+
+CoprocessPool starts `size` long-lived Python children once and sends
+requests to them over their stdin/stdout pipes. Each message is framed with a
+header holding a request id and the payload length. Many requests can be
+outstanding on one child at a time. A reader thread per child resolves each
+request's Future when the response with its id comes back.
+
+When a child's stdout reaches EOF, the child has crashed or exited. Its
+in-flight requests fail with ChildProcessError, and the pool starts a
+replacement after a delay that doubles with every restart. Once a child has
+answered a request the count starts over, so occasional crashes over a long
+run are always recovered from. After max_restarts restarts in a row without a
+single answer, the pool gives up, and submit() raises RuntimeError instead of
+feeding requests to children that keep crashing. It also raises after
+shutdown().
+
+Registering a request and writing it to the child's stdin use separate locks.
+A large write can block until the child reads it, and the child only reads
+once the reader thread has drained its stdout, which needs the first lock.
+
+The children run COPROCESS_SOURCE, which looks up one of its HANDLERS by name.
+'''
+import itertools
+import struct
+
+HEADER = struct.Struct('!II') # Request id, payload length
+RESTART_DELAY = 0.05
+MAX_RESTART_DELAY = 2
+
+COPROCESS_SOURCE = r"""
+import hashlib
+import struct
+import sys
+
+HEADER = struct.Struct('!II')
+HANDLERS = {
+    'md5': lambda data: hashlib.md5(data).hexdigest().encode(),
+}
+
+handler = HANDLERS[sys.argv[1]]
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+while True:
+    header = stdin.read(HEADER.size)
+    if len(header) < HEADER.size:
+        break
+    request_id, size = HEADER.unpack(header)
+    result = handler(stdin.read(size))
+    stdout.write(HEADER.pack(request_id, len(result)) + result)
+    stdout.flush()
+"""
+
+
+class Coprocess:
+    def __init__(self, handler, on_exit):
+        self.proc = subprocess.Popen(
+            [sys.executable, '-c', COPROCESS_SOURCE, handler],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        self.on_exit = on_exit
+        self.lock = threading.Lock() # Guards pending and dead
+        self.write_lock = threading.Lock() # Keeps messages whole on stdin
+        self.pending = {}
+        self.dead = False
+        self.answered = 0
+        self.reader = threading.Thread(target=self.read_responses,
+                                       daemon=True)
+        self.reader.start()
+
+    def submit(self, request_id, payload, future):
+        with self.lock:
+            if self.dead:
+                raise ChildProcessError('coprocess has exited')
+            self.pending[request_id] = future
+
+        # The write blocks once the child's stdin pipe is full, and the child
+        # only reads it while the reader drains its stdout. So the reader
+        # must never wait for this lock.
+        with self.write_lock:
+            try:
+                self.proc.stdin.write(
+                    HEADER.pack(request_id, len(payload)) + payload)
+                self.proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                pass # The reader sees EOF and fails the pending futures
+
+    def read_responses(self):
+        stdout = self.proc.stdout
+        while True:
+            header = stdout.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            request_id, size = HEADER.unpack(header)
+            data = stdout.read(size)
+            with self.lock:
+                future = self.pending.pop(request_id)
+            self.answered += 1
+            settle(future, data) # The caller may have cancelled it
+
+        with self.lock:
+            self.dead = True
+            pending, self.pending = self.pending, {}
+        stdout.close()
+        returncode = self.proc.wait()
+        self.close_stdin()
+        for future in pending.values():
+            settle(future, exception=ChildProcessError(
+                'coprocess exited with status %d' % returncode))
+        self.on_exit(self)
+
+    def close_stdin(self):
+        with self.write_lock:
+            try:
+                self.proc.stdin.close() # The child exits at EOF
+            except BrokenPipeError:
+                pass
+
+    def close(self):
+        self.close_stdin()
+        self.reader.join()
+
+
+class CoprocessPool:
+    def __init__(self, handler, size=4, max_restarts=10):
+        self.handler = handler
+        self.max_restarts = max_restarts
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.request_ids = itertools.count()
+        self.shutting_down = False
+        self.failed = False
+        self.restarts = 0
+        self.failures = 0 # Restarts since a child last answered a request
+        self.children = [Coprocess(handler, self.replace)
+                         for _ in range(size)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def replace(self, child):
+        with self.lock:
+            if self.shutting_down or self.failed:
+                return
+            if child.answered:
+                self.failures = 0 # It was healthy, so this is a new problem
+            if self.failures >= self.max_restarts:
+                self.failed = True # Stop restarting a child that can't run
+                self.changed.notify_all()
+                return
+            delay = min(RESTART_DELAY * 2**self.failures, MAX_RESTART_DELAY)
+            self.failures += 1
+            self.restarts += 1
+
+        time.sleep(delay) # Back off so a crash on startup doesn't spin
+
+        with self.lock:
+            if self.shutting_down:
+                return
+            index = self.children.index(child)
+            try:
+                self.children[index] = Coprocess(self.handler, self.replace)
+            except OSError:
+                self.failed = True
+            self.changed.notify_all()
+
+    def submit(self, payload):
+        future = Future()
+        while True:
+            with self.lock:
+                while True:
+                    if self.shutting_down:
+                        raise RuntimeError('cannot submit after shutdown')
+                    if self.failed:
+                        raise RuntimeError(
+                            'coprocesses exited %d times in a row, '
+                            'giving up' % self.failures)
+                    live = [child for child in self.children
+                            if not child.dead]
+                    if live:
+                        break
+                    self.changed.wait() # Every child is being replaced
+                # Ids must fit the '!I' header field
+                request_id = next(self.request_ids) % 2**32
+                child = live[request_id % len(live)]
+            try:
+                child.submit(request_id, payload, future)
+                return future
+            except ChildProcessError:
+                continue # Died since we looked; try another child
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+            self.changed.notify_all()
+            children = list(self.children)
+        for child in children:
+            child.close()
+
+
+payloads = [os.urandom(10) for _ in range(200)]
+
+start = time.time()
+for data in payloads:
+    subprocess.run(MD5_COMMAND, input=data, stdout=subprocess.PIPE)
+end = time.time()
+print('One %s child per item: %.1f us per item' %
+      (MD5_COMMAND[0], (end - start) / len(payloads) * 1e6))
+
+with CoprocessPool('md5', size=4) as pool:
+    pool.submit(b'').result() # Wait for the children to start
+
+    start = time.time()
+    for data in payloads:
+        pool.submit(data).result()
+    end = time.time()
+    print('Coprocess round trip: %.1f us per item' %
+          ((end - start) / len(payloads) * 1e6))
+
+    start = time.time()
+    futures = [pool.submit(data) for data in payloads]
+    digests = [future.result() for future in futures]
+    end = time.time()
+    print('Coprocess pipelined: %.1f us per item' %
+          ((end - start) / len(payloads) * 1e6))
+    assert digests == [hashlib.md5(data).hexdigest().encode()
+                       for data in payloads]
+
+    pool.children[0].proc.kill() # Simulate a crash
+    pool.children[0].reader.join()
+    results = [pool.submit(data).result() for data in payloads[:8]]
+    print('After a crash:', len(results), 'requests succeeded,',
+          pool.restarts, 'child restarted')
+print()
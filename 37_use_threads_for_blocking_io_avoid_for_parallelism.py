@@ -11,12 +11,14 @@ def factorize(number):
 
 
 numbers = [2139079, 1214759, 1516637, 1852285]
-start = time()
-for number in numbers:
-    list(factorize(number))
 
-end = time()
-print('Took %.3f seconds' % (end - start))
+if __name__ == '__main__':
+    start = time()
+    for number in numbers:
+        list(factorize(number))
+
+    end = time()
+    print('Took %.3f seconds' % (end - start))
 
 
 '''
@@ -37,15 +39,391 @@ class FactorizeThread(Thread):
         self.factors = list(factorize(self.number))
 
 
-start = time()
-threads = []
-for number in numbers:
-    thread = FactorizeThread(number)
-    thread.start()
-    threads.append(thread)
+if __name__ == '__main__':
+    start = time()
+    threads = []
+    for number in numbers:
+        thread = FactorizeThread(number)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    end = time()
+    print('Took %.3f seconds' % (end - start))
+
+
+
+'''
+Neither version above gets far because factorize itself is slow: it tests
+every integer from 1 to n, so each call is O(n).
+
+Divisors come in pairs: if i divides n, so does n // i, and one of the two is
+at most sqrt(n). Testing up to isqrt(n) finds both halves in O(sqrt(n)). The
+small divisor of each pair is yielded right away. The large ones are yielded
+in reverse at the end, so the output stays in ascending order.
+
+For large inputs even sqrt(n) is too slow. Above SQRT_LIMIT the number is
+split into its prime factors instead:
+- trial division by the small primes,
+- a Miller-Rabin test to tell whether what's left is prime,
+- Pollard's rho (Brent's variant) to split what's left when it isn't.
+The divisors are then built from the prime factorization.
+'''
+import random
+from math import gcd, isqrt
+
+SQRT_LIMIT = 10**10
+SMALL_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+slow_factorize = factorize
+
+
+def is_prime(n):
+    if n < 2:
+        return False
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    # These bases are deterministic for every n below 3.3 * 10**24
+    for a in SMALL_PRIMES:
+        x = pow(a, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def pollard_rho(n):
+    if n % 2 == 0:
+        return 2
+    while True:
+        y = random.randrange(1, n)
+        c = random.randrange(1, n)
+        m = 128
+        g = r = q = 1
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(m, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = gcd(q, n)
+                k += m
+            r *= 2
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = gcd(abs(x - ys), n)
+        if g != n:
+            return g
+
+def prime_factors(number):
+    factors = {}
+    for p in SMALL_PRIMES:
+        while number % p == 0:
+            factors[p] = factors.get(p, 0) + 1
+            number //= p
+
+    remaining = [number] if number > 1 else []
+    while remaining:
+        n = remaining.pop()
+        if is_prime(n):
+            factors[n] = factors.get(n, 0) + 1
+        else:
+            d = pollard_rho(n)
+            remaining.extend((d, n // d))
+    return factors
+
+def divisors_from_factors(factors):
+    divisors = [1]
+    for p, exponent in factors.items():
+        divisors = [d * p**e for d in divisors for e in range(exponent + 1)]
+    return sorted(divisors)
+
+def factorize(number):
+    if number < 1:
+        return
+    if number > SQRT_LIMIT:
+        yield from divisors_from_factors(prime_factors(number))
+        return
+
+    large = []
+    for i in range(1, isqrt(number) + 1):
+        if number % i == 0:
+            yield i
+            if i != number // i:
+                large.append(number // i)
+    yield from reversed(large)
+
+
+if __name__ == '__main__':
+    for number in numbers:
+        assert list(factorize(number)) == list(slow_factorize(number))
+
+    for name, func in (('slow_factorize', slow_factorize),
+                       ('factorize', factorize)):
+        start = time()
+        for number in numbers:
+            list(func(number))
+        end = time()
+        print('%s took %.3f seconds' % (name, end - start))
+
+    big = (10**9 + 7) * (10**9 + 9) * 2**5
+    start = time()
+    factors = list(factorize(big))
+    end = time()
+    print('%d has %d divisors, took %.3f seconds' % (big, len(factors),
+                                                     end - start))
+
+
+
+'''
+When factorize is applied over a big list, every call starts from scratch, and
+FactorizeThread gets no speedup because of the GIL.
+
+factorize_many builds a smallest-prime-factor sieve up to a bound once. Each
+sieve entry holds the smallest prime that divides that index, or 0 if the index
+is prime, so factoring any number up to the bound is just repeated division.
+The sieve lives in a SharedMemory block. Every process in the pool maps the
+block in its initializer instead of receiving a copy. The numbers are then
+split into chunks across the pool.
+
+By default the bound is the largest number, capped at SIEVE_LIMIT so that one
+huge input can't size the sieve. Numbers above the bound fall back to
+prime_factors from above. The workers compare against the bound itself, not
+the size of the block, because the block can come back rounded up.
+
+Every demo in this file runs under a __main__ guard. Under the spawn and
+forkserver start methods, each worker imports the module again, and would
+otherwise rerun the benchmarks.
+'''
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+SIEVE_LIMIT = 10**7
+FILL_CHUNK = 64 * 1024
+
+sieve_block = None
+sieve = None
+sieve_bound = 0
+
+
+def fill_sieve(sieve, bound):
+    small = bytearray([1]) * (isqrt(bound) + 1)
+    primes = []
+    for p in range(2, len(small)):
+        if small[p]:
+            primes.append(p)
+            small[p * p::p] = bytes(len(range(p * p, len(small), p)))
+
+    # Writes go straight into the shared view, a bounded chunk at a time, so
+    # the parent never holds a second full-size copy of the sieve
+    fill = array('i', [0]) * FILL_CHUNK
+    for start in range(0, bound + 1, FILL_CHUNK):
+        end = min(start + FILL_CHUNK, bound + 1)
+        sieve[start:end] = memoryview(fill)[:end - start]
+
+    # Larger primes first, so smaller ones overwrite their shared multiples
+    for p in reversed(primes):
+        fill = memoryview(array('i', [p]) * FILL_CHUNK)
+        for start in range(p * p, bound + 1, p * FILL_CHUNK):
+            end = min(start + p * FILL_CHUNK, bound + 1)
+            sieve[start:end:p] = fill[:len(range(start, end, p))]
+
+def attach_sieve(name, bound):
+    global sieve_block, sieve, sieve_bound
+    sieve_block = SharedMemory(name=name)
+    sieve = sieve_block.buf.cast('i')
+    # The block may be bigger than asked for (macOS rounds it up to whole
+    # pages), and the entries past the bound were never filled in
+    sieve_bound = bound
+
+def sieve_prime_factors(number):
+    if number > sieve_bound:
+        return prime_factors(number)
+    factors = {}
+    while number > 1:
+        p = sieve[number] or number
+        factors[p] = factors.get(p, 0) + 1
+        number //= p
+    return factors
+
+def factorize_chunk(chunk):
+    return [divisors_from_factors(sieve_prime_factors(number))
+            if number >= 1 else []
+            for number in chunk]
+
+def factorize_many(numbers, workers=None, bound=None):
+    numbers = list(numbers)
+    if not numbers:
+        return []
+    if workers is None:
+        workers = os.cpu_count()
+    if bound is None:
+        bound = min(max(numbers), SIEVE_LIMIT)
+    bound = max(bound, 2)
+
+    block = SharedMemory(create=True, size=(bound + 1) * array('i').itemsize)
+    try:
+        with block.buf.cast('i') as view:
+            fill_sieve(view, bound)
+
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=attach_sieve,
+                                 initargs=(block.name, bound)) as pool:
+            chunk_size = max(1, len(numbers) // (workers * 4))
+            chunks = [numbers[i:i + chunk_size]
+                      for i in range(0, len(numbers), chunk_size)]
+            return [divisors
+                    for result in pool.map(factorize_chunk, chunks)
+                    for divisors in result]
+    finally:
+        block.close()
+        block.unlink()
+
+
+if __name__ == '__main__':
+    many = numbers + [random.randint(1, 2 * 10**6) for _ in range(20000)]
+
+    start = time()
+    expected = [list(factorize(number)) for number in many]
+    end = time()
+    print('factorize over %d numbers took %.3f seconds' %
+          (len(many), end - start))
+
+    for workers in (1, 2, 4):
+        start = time()
+        result = factorize_many(many, workers=workers)
+        end = time()
+        assert result == expected
+        print('factorize_many with %d workers took %.3f seconds' %
+              (workers, end - start))
+
+
+
+'''
+When the same numbers come up again and again, they shouldn't be factored
+again each time.
+
+FactorizationCache memoizes prime factorizations and builds the full divisor
+list from the cached factorization on every call. Divisor lists can be huge,
+but a factorization is just a few (prime, exponent) pairs.
+
+The cache is bounded by an estimated size in bytes, not by an entry count.
+Entries are kept in an OrderedDict in least-recently-used order, and the
+oldest ones are evicted once the budget is exceeded. A Lock guards the
+dictionary and the hit/miss counters. The factoring itself happens outside the
+lock, so threads that miss don't block each other.
+'''
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+
+class FactorizationCache:
+    def __init__(self, max_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def prime_factors(self, number):
+        if number < 1:
+            # prime_factors would never finish dividing 0
+            raise ValueError('Can only factor positive integers, got %r' %
+                             number)
+        with self.lock:
+            entry = self.entries.get(number)
+            if entry is not None:
+                self.entries.move_to_end(number)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        factors = tuple(sorted(prime_factors(number).items()))
+        size = self.entry_size(number, factors)
+        with self.lock:
+            if number not in self.entries and size <= self.max_bytes:
+                self.entries[number] = (factors, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.size -= evicted_size
+        return factors
+
+    @staticmethod
+    def entry_size(number, factors):
+        return (sys.getsizeof(number) + sys.getsizeof(factors) +
+                sum(sys.getsizeof(pair) + sys.getsizeof(pair[0]) +
+                    sys.getsizeof(pair[1]) for pair in factors))
+
+    def factorize(self, number):
+        if number < 1:
+            return
+        yield from divisors_from_factors(dict(self.prime_factors(number)))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.size,
+            }
+
+
+class CachedFactorizeThread(Thread):
+    def __init__(self, cache, numbers):
+        super().__init__()
+        self.cache = cache
+        self.numbers = numbers
+
+    def run(self):
+        self.factors = [list(self.cache.factorize(number))
+                        for number in self.numbers]
+
+
+if __name__ == '__main__':
+    popular = [random.randint(10**12, 10**13) for _ in range(200)]
+    workload = [random.choice(popular) for _ in range(5000)]
+
+    start = time()
+    for number in workload:
+        list(factorize(number))
+    end = time()
+    print('Uncached factorize took %.3f seconds' % (end - start))
 
-for thread in threads:
-    thread.join()
+    cache = FactorizationCache(max_bytes=64 * 1024)
+    start = time()
+    threads = []
+    for i in range(4):
+        thread = CachedFactorizeThread(cache, workload[i::4])
+        thread.start()
+        threads.append(thread)
 
-end = time()
-print('Took %.3f seconds' % (end - start))
+    for thread in threads:
+        thread.join()
+    end = time()
+    print('Cached factorize took %.3f seconds' % (end - start),
+          cache.stats())
@@ -196,3 +196,1051 @@ resize_queue.join()
 upload_queue.close()
 upload_queue.join()
 print(done_queue.qsize(), 'items finished')
+
+
+
+'''
+Event-driven MyQueue
+
+The MyQueue/Worker pipeline at the top of this file busy-waits in two places:
+- Worker.run catches IndexError and sleeps 1 ms whenever its queue is empty.
+- The driver spins on len(done_queue.items) until everything is done.
+This burns whole cores and adds up to a millisecond of latency per hop.
+
+A Condition built on the queue's own lock fixes both:
+- get(timeout=...) sleeps until put() notifies it. It only raises IndexError
+  if the timeout expires, so get(timeout=0) is the old non-blocking behavior.
+- wait_for_len(count) sleeps until the queue holds count items.
+
+PollingWorker keeps today's behavior so the two can be compared. Both workers
+can be stopped, and both record the CPU time their thread used.
+'''
+from threading import Condition
+from time import thread_time, time
+
+
+class MyQueue:
+    def __init__(self):
+        self.items = deque()
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.grown = Condition(self.lock)
+
+    def put(self, item):
+        with self.lock:
+            self.items.append(item)
+            self.not_empty.notify()
+            self.grown.notify_all()
+
+    def get(self, timeout=None):
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.items, timeout):
+                raise IndexError('get from an empty MyQueue')
+            return self.items.popleft()
+
+    def wait_for_len(self, count, timeout=None):
+        with self.grown:
+            return self.grown.wait_for(lambda: len(self.items) >= count,
+                                       timeout)
+
+
+class PollingWorker(Thread):
+    def __init__(self, func, in_queue, out_queue):
+        super().__init__()
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.polled_count = 0
+        self.work_done = 0
+        self.error_count = 0
+        self.cpu_time = 0
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def next_item(self):
+        try:
+            return self.in_queue.get(timeout=0)
+        except IndexError:
+            sleep(0.001) # No work to do
+            self.error_count += 1
+            raise
+
+    def run(self):
+        while self.running:
+            self.polled_count += 1
+            try:
+                item = self.next_item()
+            except IndexError:
+                continue
+            result = self.func(item)
+            self.out_queue.put(result)
+            self.work_done += 1
+        self.cpu_time = thread_time()
+
+
+class Worker(PollingWorker):
+    def next_item(self):
+        try:
+            # Wakes up on put(), or periodically to notice stop()
+            return self.in_queue.get(timeout=0.1)
+        except IndexError:
+            self.error_count += 1
+            raise
+
+
+def spin_until_len(queue, count):
+    while len(queue.items) < count:
+        pass
+
+def wait_until_len(queue, count):
+    queue.wait_for_len(count)
+
+def run_pipeline(worker_class, wait_done, count=1000, interval=0):
+    download_queue = MyQueue()
+    resize_queue = MyQueue()
+    upload_queue = MyQueue()
+    done_queue = MyQueue()
+    threads = [
+        worker_class(download, download_queue, resize_queue),
+        worker_class(resize, resize_queue, upload_queue),
+        worker_class(upload, upload_queue, done_queue)
+    ]
+
+    start = time()
+    for thread in threads:
+        thread.start()
+
+    for _ in range(count):
+        download_queue.put(object())
+        if interval:
+            sleep(interval) # A producer that leaves the pipeline idle
+
+    wait_start = thread_time()
+    wait_done(done_queue, count)
+    wait_cpu_time = thread_time() - wait_start
+    end = time()
+
+    for thread in threads:
+        thread.stop()
+        thread.join()
+
+    polled = sum(t.polled_count for t in threads)
+    cpu_time = sum(t.cpu_time for t in threads) + wait_cpu_time
+    print('%s: processed %d items after polling %d times, '
+          'took %.3f seconds using %.3f CPU seconds' %
+          (worker_class.__name__, len(done_queue.items), polled,
+           end - start, cpu_time))
+
+
+for interval in (0, 0.001):
+    print('Producer interval', interval)
+    run_pipeline(PollingWorker, spin_until_len, interval=interval)
+    run_pipeline(Worker, wait_until_len, interval=interval)
+
+
+
+'''
+Batched ClosableQueue
+
+Every item that moves through the StoppableWorker pipeline pays a full lock
+round trip for put(), get() and task_done() in every stage. With millions of
+small items, that overhead dominates the real work.
+
+put_many() and get_many() take the queue's mutex once per batch. They use the
+same internals as Queue.put() and Queue.get(): _put(), _get(), the not_empty
+and not_full conditions, and unfinished_tasks. task_done_many() marks a whole
+batch as done, so join() still works.
+
+get_many() stops right after a SENTINEL. iter_batches() yields the items that
+came before it, then returns. BatchStoppableWorker applies its func to whole
+batches: func takes a list of items and returns a list of results.
+'''
+from queue import Empty
+
+
+class ClosableQueue(Queue):
+    SENTINEL = object()
+
+    def close(self):
+        self.put(self.SENTINEL)
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            try:
+                if item is self.SENTINEL:
+                    return # Cause the thread to exit
+                yield item
+            finally:
+                self.task_done()
+
+    def put_many(self, items):
+        with self.not_full:
+            for item in items:
+                if self.maxsize > 0:
+                    while self._qsize() >= self.maxsize:
+                        self.not_full.wait()
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+
+    def get_many(self, max_items, timeout=None):
+        with self.not_empty:
+            if not self.not_empty.wait_for(self._qsize, timeout):
+                raise Empty
+            items = []
+            while self._qsize() and len(items) < max_items:
+                item = self._get()
+                items.append(item)
+                if item is self.SENTINEL:
+                    break # Leave anything after it for the next consumer
+            self.not_full.notify(len(items))
+            return items
+
+    def task_done_many(self, count):
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - count
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            if unfinished == 0:
+                self.all_tasks_done.notify_all()
+            self.unfinished_tasks = unfinished
+
+    def iter_batches(self, max_items):
+        while True:
+            batch = self.get_many(max_items)
+            try:
+                if batch[-1] is self.SENTINEL:
+                    if len(batch) > 1:
+                        yield batch[:-1]
+                    return # Cause the thread to exit
+                yield batch
+            finally:
+                self.task_done_many(len(batch))
+
+
+class BatchStoppableWorker(Thread):
+    def __init__(self, func, in_queue, out_queue, batch_size=100):
+        super().__init__()
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.batch_size = batch_size
+
+    def run(self):
+        for batch in self.in_queue.iter_batches(self.batch_size):
+            self.out_queue.put_many(self.func(batch))
+
+
+def run_closable_pipeline(make_worker, put_items, count):
+    download_queue = ClosableQueue()
+    resize_queue = ClosableQueue()
+    upload_queue = ClosableQueue()
+    done_queue = ClosableQueue()
+    threads = [
+        make_worker(download_queue, resize_queue),
+        make_worker(resize_queue, upload_queue),
+        make_worker(upload_queue, done_queue)
+    ]
+
+    start = time()
+    for thread in threads:
+        thread.start()
+
+    put_items(download_queue, [object() for _ in range(count)])
+
+    download_queue.close()
+    download_queue.join()
+    resize_queue.close()
+    resize_queue.join()
+    upload_queue.close()
+    upload_queue.join()
+    end = time()
+    print('%d items finished, took %.3f seconds' %
+          (done_queue.qsize(), end - start))
+
+def put_each(queue, items):
+    for item in items:
+        queue.put(item)
+
+count = 10**5
+run_closable_pipeline(
+    lambda in_queue, out_queue: StoppableWorker(
+        lambda x: object(), in_queue, out_queue),
+    put_each, count)
+run_closable_pipeline(
+    lambda in_queue, out_queue: BatchStoppableWorker(
+        lambda batch: [object() for _ in batch], in_queue, out_queue),
+    ClosableQueue.put_many, count)
+
+
+
+'''
+Multi-worker stages
+
+With exactly one StoppableWorker per stage, the slowest stage caps the
+throughput of the whole pipeline, however idle the other stages are.
+
+A Stage runs `count` worker threads against one input ClosableQueue. close()
+puts one SENTINEL per thread, so every thread sees one and exits. join() waits
+for all of them.
+
+With several workers, results come out in completion order. When ordered is
+set, items travel through the pipeline as (sequence number, item) pairs. Each
+stage parks early results in a reorder buffer and only emits the next expected
+sequence number, so the output keeps the input order.
+'''
+class Stage:
+    def __init__(self, func, in_queue, out_queue, count=1, ordered=False):
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.ordered = ordered
+        self.lock = Lock()
+        self.next_seq = 0
+        self.reorder_buffer = {}
+        self.threads = [Thread(target=self.run) for _ in range(count)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        for item in self.in_queue:
+            if self.ordered:
+                seq, item = item
+                self.emit(seq, self.func(item))
+            else:
+                self.out_queue.put(self.func(item))
+
+    def emit(self, seq, result):
+        with self.lock:
+            self.reorder_buffer[seq] = result
+            while self.next_seq in self.reorder_buffer:
+                result = self.reorder_buffer.pop(self.next_seq)
+                self.out_queue.put((self.next_seq, result))
+                self.next_seq += 1
+
+    def close(self):
+        for _ in self.threads:
+            self.in_queue.close()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+def slow_resize(item):
+    sleep(0.001) # Stands in for work that releases the GIL
+    return item
+
+def run_stages(resize_count, ordered, count=1000):
+    download_queue = ClosableQueue()
+    resize_queue = ClosableQueue()
+    upload_queue = ClosableQueue()
+    done_queue = ClosableQueue()
+    stages = [
+        Stage(lambda x: x, download_queue, resize_queue, ordered=ordered),
+        Stage(slow_resize, resize_queue, upload_queue, count=resize_count,
+              ordered=ordered),
+        Stage(lambda x: x, upload_queue, done_queue, ordered=ordered)
+    ]
+
+    start = time()
+    for stage in stages:
+        stage.start()
+
+    for i in range(count):
+        download_queue.put((i, i) if ordered else i)
+
+    for stage in stages:
+        stage.close()
+        stage.join()
+    end = time()
+
+    results = [done_queue.get() for _ in range(done_queue.qsize())]
+    if ordered:
+        in_order = [seq for seq, _ in results] == list(range(count))
+    else:
+        in_order = results == list(range(count))
+    print('%d resize workers, ordered=%s: %d items in order=%s, '
+          'took %.3f seconds' % (resize_count, ordered, len(results),
+                                 in_order, end - start))
+
+for resize_count in (1, 4):
+    for ordered in (False, True):
+        run_stages(resize_count, ordered)
+
+
+
+'''
+Process-backed stages
+
+Thread stages can't speed up a CPU-bound resize because of the GIL.
+
+A ProcessStage has the same start()/close()/join() interface as Stage and
+reads the same ClosableQueue, so thread and process stages compose in one
+pipeline. Its work is done by `count` child processes:
+- A feeder thread copies each payload into a new SharedMemory block and sends
+  only the block's name and size to the children.
+- A child attaches to the block and calls func with a memoryview of it. It
+  writes the result into a new block and sends back that block's name.
+- A collector thread copies the result into bytes for the output queue and
+  unlinks both blocks.
+The payload bytes themselves are never pickled.
+
+If func raises, or its result can't be stored (it isn't bytes-like, or it
+still holds a view of the payload), the child sends the exception back
+instead of a result. The collector unlinks the item's block and keeps the
+exception, and join() raises the first one once the stage has shut down. The
+other items keep flowing. If a child dies outright, the collector notices its
+exit status while waiting for responses. Its lost items' blocks are unlinked,
+and join() raises ChildProcessError.
+
+Payloads must be bytes-like, and func must be defined at module level so the
+child processes can find it.
+'''
+import multiprocessing
+import os
+import pickle
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+
+def process_stage_main(func, requests, responses):
+    while True:
+        request = requests.get()
+        if request is None:
+            responses.put(None)
+            return
+
+        in_name, size = request
+        try:
+            out_name, out_size = process_item(func, in_name, size)
+        except Exception as e:
+            responses.put((in_name, None, picklable_error(e)))
+        else:
+            responses.put((in_name, out_name, out_size))
+
+def process_item(func, in_name, size):
+    in_block = SharedMemory(name=in_name)
+    out_block = None
+    try:
+        with in_block.buf[:size] as payload:
+            out_block, out_size = write_result(func(payload))
+        # Raises BufferError if func kept a view of the payload
+        in_block.close()
+    except BaseException:
+        if out_block is not None:
+            out_block.close()
+            out_block.unlink()
+        try:
+            in_block.close()
+        except BufferError:
+            pass
+        raise
+
+    out_block.close()
+    return out_block.name, out_size
+
+def write_result(result):
+    # Raises TypeError unless result is bytes-like
+    with memoryview(result) as view:
+        contiguous = view if view.c_contiguous else memoryview(view.tobytes())
+        with contiguous.cast('B') as data:
+            block = SharedMemory(create=True, size=max(data.nbytes, 1))
+            block.buf[:data.nbytes] = data
+            return block, data.nbytes
+
+def picklable_error(error):
+    try:
+        pickle.dumps(error)
+    except Exception:
+        return RuntimeError(repr(error))
+    return error
+
+
+class ProcessStage:
+    def __init__(self, func, in_queue, out_queue, count=1):
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.requests = multiprocessing.Queue()
+        self.responses = multiprocessing.Queue()
+        self.lock = Lock()
+        self.in_flight = {}
+        self.errors = []
+        self.processes = [
+            multiprocessing.Process(
+                target=process_stage_main,
+                args=(func, self.requests, self.responses),
+                daemon=True)
+            for _ in range(count)]
+        self.feeder = Thread(target=self.feed)
+        self.collector = Thread(target=self.collect)
+
+    def start(self):
+        # Children must share the parent's tracker, since blocks they create
+        # are unlinked by the parent
+        resource_tracker.ensure_running()
+        for process in self.processes:
+            process.start()
+        self.feeder.start()
+        self.collector.start()
+
+    def feed(self):
+        for item in self.in_queue:
+            block = SharedMemory(create=True, size=max(len(item), 1))
+            block.buf[:len(item)] = item
+            with self.lock:
+                self.in_flight[block.name] = block
+            self.requests.put((block.name, len(item)))
+
+        for _ in self.processes:
+            self.requests.put(None)
+
+    def crashed(self):
+        # Children that exited without sending their final None
+        return [process for process in self.processes
+                if process.exitcode not in (None, 0)]
+
+    def collect(self):
+        finished = 0
+        while finished + len(self.crashed()) < len(self.processes):
+            try:
+                response = self.responses.get(timeout=0.1)
+            except Empty:
+                continue # Check again whether a child has died
+            if response is None:
+                finished += 1
+                continue
+
+            in_name, out_name, size = response
+            with self.lock:
+                in_block = self.in_flight.pop(in_name)
+            in_block.close()
+            in_block.unlink()
+
+            if out_name is None:
+                self.errors.append(size) # The exception func raised
+                continue
+
+            out_block = SharedMemory(name=out_name)
+            self.out_queue.put(bytes(out_block.buf[:size]))
+            out_block.close()
+            out_block.unlink()
+
+    def close(self):
+        self.in_queue.close()
+
+    def join(self):
+        self.feeder.join()
+        self.collector.join()
+        for process in self.processes:
+            process.join()
+
+        crashed = self.crashed()
+        for process in crashed:
+            self.errors.append(ChildProcessError(
+                'ProcessStage child exited with status %d' %
+                process.exitcode))
+        if crashed:
+            # Requests nobody will read must not block this process's exit
+            self.requests.cancel_join_thread()
+        with self.lock:
+            lost, self.in_flight = self.in_flight, {}
+        for block in lost.values():
+            block.close()
+            block.unlink()
+
+        if self.errors:
+            raise self.errors[0]
+
+
+def download_image(item):
+    return os.urandom(256 * 1024)
+
+def resize_image(image):
+    # Keeps every fourth byte, slowly enough to be CPU-bound
+    return bytes(image[i] for i in range(0, len(image), 4))
+
+def upload_image(image):
+    return len(image)
+
+def run_image_pipeline(make_resize_stage, count=100):
+    download_queue = ClosableQueue()
+    resize_queue = ClosableQueue()
+    upload_queue = ClosableQueue()
+    done_queue = ClosableQueue()
+    stages = [
+        Stage(download_image, download_queue, resize_queue),
+        make_resize_stage(resize_queue, upload_queue),
+        Stage(upload_image, upload_queue, done_queue)
+    ]
+
+    start = time()
+    for stage in stages:
+        stage.start()
+
+    for _ in range(count):
+        download_queue.put(object())
+
+    for stage in stages:
+        stage.close()
+        stage.join()
+    end = time()
+    print('%s resize: %d images finished, took %.3f seconds' %
+          (type(stages[1]).__name__, done_queue.qsize(), end - start))
+
+
+if __name__ == '__main__':
+    run_image_pipeline(
+        lambda in_queue, out_queue: Stage(
+            resize_image, in_queue, out_queue, count=4))
+    run_image_pipeline(
+        lambda in_queue, out_queue: ProcessStage(
+            resize_image, in_queue, out_queue, count=4))
+
+
+
+'''
+Backpressure and per-stage stats
+
+All the ClosableQueues above are unbounded. A fast download stage in front of
+a slow resize stage buffers without limit, and memory use grows with it.
+
+InstrumentedQueue takes a capacity and a policy for what put() does when the
+queue is full:
+- 'block' waits for room, which pushes back on the producer.
+- 'drop_newest' discards the item being put.
+- 'drop_oldest' discards the item at the head to make room.
+A SENTINEL is never dropped. The queue also counts puts, gets and drops,
+tracks its maximum depth, and adds up the time callers spent blocked in put()
+and get().
+
+InstrumentedStage keeps the latencies of recent func calls. stats() returns a
+snapshot of its throughput, latency percentiles and input queue numbers.
+PipelineMonitor prints those snapshots periodically while the pipeline runs,
+which shows where items pile up and which stage needs more workers.
+'''
+from statistics import quantiles
+from time import perf_counter
+
+
+class InstrumentedQueue(ClosableQueue):
+    def __init__(self, maxsize=0, policy='block'):
+        super().__init__(maxsize)
+        self.policy = policy
+        self.stats_lock = Lock()
+        self.put_count = 0
+        self.get_count = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.put_blocked = 0
+        self.get_blocked = 0
+
+    def put(self, item, block=True, timeout=None):
+        start = perf_counter()
+        if item is self.SENTINEL or self.policy == 'block':
+            super().put(item, block, timeout)
+        elif not self.put_or_drop(item):
+            return
+        blocked = perf_counter() - start
+        depth = self.qsize() # Takes the mutex, so not under stats_lock
+        with self.stats_lock:
+            self.put_count += 1
+            self.put_blocked += blocked
+            self.max_depth = max(self.max_depth, depth)
+
+    def put_or_drop(self, item):
+        # stats_lock is only ever taken inside the mutex, never around it
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                with self.stats_lock:
+                    self.dropped += 1
+                if self.policy == 'drop_newest' or not self.drop_oldest():
+                    return False
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+    def drop_oldest(self):
+        # Called with the mutex held. Skips over sentinels, which must
+        # reach the consumers
+        for index, item in enumerate(self.queue):
+            if item is not self.SENTINEL:
+                del self.queue[index]
+                self.unfinished_tasks -= 1
+                return True
+        return False # Only sentinels are queued; drop the new item instead
+
+    def get(self, block=True, timeout=None):
+        start = perf_counter()
+        item = super().get(block, timeout)
+        blocked = perf_counter() - start
+        with self.stats_lock:
+            self.get_count += 1
+            self.get_blocked += blocked
+        return item
+
+    def stats(self):
+        depth = self.qsize()
+        with self.stats_lock:
+            return {
+                'depth': depth,
+                'capacity': self.maxsize,
+                'max_depth': self.max_depth,
+                'puts': self.put_count,
+                'gets': self.get_count,
+                'dropped': self.dropped,
+                'put_blocked': self.put_blocked,
+                'get_blocked': self.get_blocked,
+            }
+
+
+class InstrumentedStage(Stage):
+    def __init__(self, name, func, in_queue, out_queue, count=1,
+                 ordered=False, history=1000):
+        super().__init__(self.measure, in_queue, out_queue, count, ordered)
+        self.name = name
+        self.work_func = func
+        self.stats_lock = Lock()
+        self.latencies = deque(maxlen=history)
+        self.processed = 0
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = perf_counter()
+        super().start()
+
+    def join(self):
+        super().join()
+        self.finished = perf_counter() # Freezes the throughput
+
+    def measure(self, item):
+        start = perf_counter()
+        result = self.work_func(item)
+        latency = perf_counter() - start
+        with self.stats_lock:
+            self.latencies.append(latency)
+            self.processed += 1
+        return result
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = list(self.latencies)
+            processed = self.processed
+        elapsed = (self.finished or perf_counter()) - self.started
+        stats = {
+            'stage': self.name,
+            'workers': len(self.threads),
+            'processed': processed,
+            'throughput': processed / elapsed,
+        }
+        if len(latencies) > 1:
+            cuts = quantiles(latencies, n=100)
+            stats.update(p50=cuts[49], p90=cuts[89], p99=cuts[98])
+        if isinstance(self.in_queue, InstrumentedQueue):
+            stats.update(self.in_queue.stats())
+        return stats
+
+
+class PipelineMonitor(Thread):
+    def __init__(self, stages, interval=0.1):
+        super().__init__(daemon=True)
+        self.stages = stages
+        self.interval = interval
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            sleep(self.interval)
+            for stage in self.stages:
+                print(format_stats(stage.stats()))
+
+def format_stats(stats):
+    return ' '.join(
+        '%s=%.4f' % (key, value) if isinstance(value, float)
+        else '%s=%s' % (key, value)
+        for key, value in stats.items())
+
+
+def resize_slowly(item):
+    sleep(0.002)
+    return item
+
+def run_bounded_pipeline(capacity, policy, count=200):
+    download_queue = InstrumentedQueue(capacity)
+    resize_queue = InstrumentedQueue(capacity, policy)
+    upload_queue = InstrumentedQueue(capacity)
+    done_queue = ClosableQueue()
+    stages = [
+        InstrumentedStage('download', lambda x: x, download_queue,
+                          resize_queue),
+        InstrumentedStage('resize', resize_slowly, resize_queue,
+                          upload_queue),
+        InstrumentedStage('upload', lambda x: x, upload_queue, done_queue)
+    ]
+    monitor = PipelineMonitor(stages, interval=0.2)
+
+    for stage in stages:
+        stage.start()
+    monitor.start()
+
+    for i in range(count):
+        download_queue.put(i)
+
+    for stage in stages:
+        stage.close()
+        stage.join()
+    monitor.stop()
+    monitor.join()
+
+    print('capacity=%d policy=%s: %d of %d items finished' %
+          (capacity, policy, done_queue.qsize(), count))
+    for stage in stages:
+        print(format_stats(stage.stats()))
+
+run_bounded_pipeline(10, 'block')
+run_bounded_pipeline(10, 'drop_oldest')
+
+
+
+'''
+asyncio pipeline
+
+One OS thread per stage doesn't scale for I/O-bound stages like download and
+upload. Each thread handles only one transfer at a time.
+
+AsyncClosableQueue gives asyncio.Queue the same close() and iteration behavior
+as ClosableQueue, using async for. AsyncStage runs `concurrency` consumer tasks
+against one input queue, so thousands of items can be in flight on a single
+thread. If an executor is given, func is a plain function and runs in that
+executor, which keeps CPU-bound stages off the event loop. Otherwise func is a
+coroutine function.
+'''
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+
+class AsyncClosableQueue(asyncio.Queue):
+    SENTINEL = object()
+
+    async def close(self):
+        await self.put(self.SENTINEL)
+
+    async def __aiter__(self):
+        while True:
+            item = await self.get()
+            try:
+                if item is self.SENTINEL:
+                    return # Cause the task to exit
+                yield item
+            finally:
+                self.task_done()
+
+
+class AsyncStage:
+    def __init__(self, func, in_queue, out_queue, concurrency=1,
+                 executor=None):
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.concurrency = concurrency
+        self.executor = executor
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run())
+                      for _ in range(self.concurrency)]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        async for item in self.in_queue:
+            if self.executor is None:
+                result = await self.func(item)
+            else:
+                result = await loop.run_in_executor(
+                    self.executor, self.func, item)
+            await self.out_queue.put(result)
+
+    async def close(self):
+        for _ in self.tasks:
+            await self.in_queue.close()
+
+    async def join(self):
+        await asyncio.gather(*self.tasks)
+
+
+async def download_async(item):
+    await asyncio.sleep(0.1) # Waiting on the network
+    return os.urandom(16 * 1024)
+
+async def upload_async(image):
+    await asyncio.sleep(0.1)
+    return len(image)
+
+async def run_async_pipeline(count=2000):
+    download_queue = AsyncClosableQueue()
+    resize_queue = AsyncClosableQueue()
+    upload_queue = AsyncClosableQueue()
+    done_queue = AsyncClosableQueue()
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        stages = [
+            AsyncStage(download_async, download_queue, resize_queue,
+                       concurrency=1000),
+            AsyncStage(resize_image, resize_queue, upload_queue,
+                       concurrency=8, executor=executor),
+            AsyncStage(upload_async, upload_queue, done_queue,
+                       concurrency=1000)
+        ]
+
+        start = time()
+        for stage in stages:
+            stage.start()
+
+        for i in range(count):
+            await download_queue.put(i)
+
+        for stage in stages:
+            await stage.close()
+            await stage.join()
+        end = time()
+
+    print('asyncio pipeline: %d items finished, took %.3f seconds' %
+          (done_queue.qsize(), end - start))
+
+
+if __name__ == '__main__':
+    asyncio.run(run_async_pipeline())
+
+
+
+'''
+Retries and a dead-letter queue
+
+If func(item) raises inside StoppableWorker.run, the thread dies. Nothing
+consumes the stage's queue after that, so in_queue.join() hangs forever.
+
+ResilientStage catches exceptions from func:
+- It retries the item according to its RetryPolicy, sleeping with exponential
+  backoff between attempts.
+- Once the attempts run out, it puts (item, exception) on a dead-letter queue
+  and moves on to the next item.
+error_count, retry_count and failed_count track how often each happens, like
+the error_count of Worker at the top of this file.
+
+An unordered stage simply doesn't emit failed items. An ordered stage can't
+skip a sequence number, or every stage after it would wait for that number
+forever. So it emits FAILED in the item's place, later ResilientStages pass
+FAILED along without calling func, and the final consumer drops it.
+'''
+import random
+
+FAILED = object()
+
+
+class RetryPolicy:
+    def __init__(self, attempts=3, backoff=0.001, multiplier=2,
+                 max_backoff=0.1):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        return min(self.backoff * self.multiplier ** (attempt - 1),
+                   self.max_backoff)
+
+
+class ResilientStage(Stage):
+    def __init__(self, func, in_queue, out_queue, dead_letter_queue,
+                 count=1, ordered=False, retry_policy=None):
+        super().__init__(func, in_queue, out_queue, count, ordered)
+        self.dead_letter_queue = dead_letter_queue
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.stats_lock = Lock()
+        self.error_count = 0
+        self.retry_count = 0
+        self.failed_count = 0
+
+    def run(self):
+        for item in self.in_queue:
+            if self.ordered:
+                seq, item = item
+                result = FAILED if item is FAILED else self.process(item)
+                self.emit(seq, result)
+            else:
+                result = self.process(item)
+                if result is not FAILED:
+                    self.out_queue.put(result)
+
+    def process(self, item):
+        policy = self.retry_policy
+        for attempt in range(1, policy.attempts + 1):
+            try:
+                return self.func(item)
+            except Exception as e:
+                error = e
+                with self.stats_lock:
+                    self.error_count += 1
+                    if attempt < policy.attempts:
+                        self.retry_count += 1
+            if attempt < policy.attempts:
+                sleep(policy.delay(attempt))
+
+        with self.stats_lock:
+            self.failed_count += 1
+        self.dead_letter_queue.put((item, error))
+        return FAILED
+
+
+def flaky_resize(item):
+    if item % 100 == 0:
+        raise ValueError('Corrupt image %d' % item) # Fails every time
+    if random.random() < 0.05:
+        raise ConnectionError('Transient failure') # Fails now and then
+    return item
+
+def run_resilient_pipeline(ordered, count=1000):
+    download_queue = ClosableQueue()
+    resize_queue = ClosableQueue()
+    upload_queue = ClosableQueue()
+    done_queue = ClosableQueue()
+    dead_letter_queue = Queue()
+    stages = [
+        ResilientStage(lambda x: x, download_queue, resize_queue,
+                       dead_letter_queue, ordered=ordered),
+        ResilientStage(flaky_resize, resize_queue, upload_queue,
+                       dead_letter_queue, count=4, ordered=ordered),
+        ResilientStage(lambda x: x, upload_queue, done_queue,
+                       dead_letter_queue, ordered=ordered)
+    ]
+
+    for stage in stages:
+        stage.start()
+
+    for i in range(count):
+        download_queue.put((i, i) if ordered else i)
+
+    for stage in stages:
+        stage.close()
+        stage.join()
+
+    results = [done_queue.get() for _ in range(done_queue.qsize())]
+    if ordered:
+        results = [item for _, item in results if item is not FAILED]
+    resize = stages[1]
+    print('ordered=%s: %d finished, %d dead-lettered, %d errors, '
+          '%d retries, %d failed' %
+          (ordered, len(results), dead_letter_queue.qsize(),
+           resize.error_count, resize.retry_count, resize.failed_count))
+
+run_resilient_pipeline(ordered=False)
+run_resilient_pipeline(ordered=True)